@@ -1,74 +1,241 @@
 import os
 import json
 import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder if orjson isn't installed
+    orjson = None
 
 STATE_FILE = 'state.json'
+# Bumped when the state.json layout changes; files at this version skip migration.
+STATE_SCHEMA = 2
 DISCORD_WEBHOOK = None
 
-def load_state():
+# Discord webhook limits: each embed description holds up to 4096 characters,
+# and a single message carries at most 10 embeds totalling 6000 characters.
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_TOTAL_LIMIT = 6000
+MAX_EMBEDS_PER_MESSAGE = 10
+
+# How often to wait out a 429, and the longest Retry-After we're willing to sleep.
+MAX_RATE_LIMIT_RETRIES = 3
+MAX_RETRY_AFTER = 60
+
+# Returned by fetch_all_products when the server answers 304 Not Modified.
+UNCHANGED = object()
+
+# Pre-bound getter so the per-variant availability scan runs in C.
+_variant_available = itemgetter('available')
+
+# One pooled session for every request so Shopify and Discord connections are
+# kept alive and reused instead of doing a fresh TLS handshake per call.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    # 429s are handled by _send so the server's Retry-After is honoured for POSTs too.
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504]),
+))
+# Ask for a compressed body explicitly. make_headers only advertises br/zstd
+# when the matching decoder is installed, so responses can always be decoded.
+SESSION.headers.update(make_headers(accept_encoding=True))
+SESSION.headers['User-Agent'] = 'pokemon-restock-bot/1.0'
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_dumps(obj):
+    """Serialize obj to compact UTF-8 encoded JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+class ProductState:
+    """Per-product state tracked between runs."""
+    __slots__ = ('title', 'available', 'notified')
+
+    def __init__(self, title, available=False, notified=False):
+        self.title = title
+        self.available = available
+        self.notified = notified
+
+    @classmethod
+    def from_dict(cls, data):
+        # Older state files may lack 'notified_for_available'; default it to False.
+        return cls(data.get('title'), data.get('available', False), data.get('notified_for_available', False))
+
+    def to_dict(self):
+        return {'title': self.title, 'available': self.available, 'notified_for_available': self.notified}
+
+    def __eq__(self, other):
+        if not isinstance(other, ProductState):
+            return NotImplemented
+        return (self.title, self.available, self.notified) == (other.title, other.available, other.notified)
 
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, 'r', encoding='utf-8') as f:
-                state = json.load(f)
-                # Add backward compatibility: if a product entry doesn't have
-                # 'notified_for_available', add it and set to False.
-                if 'products' in state and isinstance(state['products'], dict):
-                    for handle, p_state in state['products'].items():
-                        if isinstance(p_state, dict) and 'notified_for_available' not in p_state:
-                            p_state['notified_for_available'] = False
-                return state
-        except json.JSONDecodeError:
-            print(f"Warning: Could not decode JSON from {STATE_FILE}. Starting with empty state.")
-            return {'products': {}}
-    return {'products': {}}  
+def load_state():
+    try:
+        # Read the raw bytes in one shot; both parsers decode UTF-8 themselves.
+        with open(STATE_FILE, 'rb') as f:
+            state = _json_loads(f.read())
+    except FileNotFoundError:
+        return {'products': {}}
+    except json.JSONDecodeError:
+        print(f"Warning: Could not decode JSON from {STATE_FILE}. Starting with empty state.")
+        return {'products': {}}
+
+    if state.get('schema') == STATE_SCHEMA:
+        # Written by this version, so every entry is a complete record.
+        state['products'] = {
+            handle: ProductState(p_state['title'], p_state['available'], p_state['notified_for_available'])
+            for handle, p_state in state['products'].items()
+        }
+    else:
+        # Older files are migrated here. The loaded state is left without the
+        # schema key so main() sees a change and saves the upgraded file.
+        state['products'] = _migrate_products(state.get('products'))
+    return state
+
+def _migrate_products(products):
+    if not isinstance(products, dict):
+        return {}
+    return {
+        handle: ProductState.from_dict(p_state)
+        for handle, p_state in products.items() if isinstance(p_state, dict)
+    }
 
 def save_state(state):
+    # Serialize in memory first so the file gets one write instead of one per token.
+    products = {handle: p_state.to_dict() for handle, p_state in state['products'].items()}
+    data = _json_dumps({**state, 'products': products})
+    # Write to a temp file and swap it in so an interrupted run can't leave a
+    # truncated state.json behind.
+    tmp_file = STATE_FILE + '.tmp'
     try:
-        with open(STATE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, STATE_FILE)
     except IOError as e:
         print(f"Error saving state to {STATE_FILE}: {e}")
 
 
-def fetch_all_products(url):
+def _header_seconds(resp, name, default):
     try:
-        resp = requests.get(f"{url.rstrip('/')}/products.json?limit=250", timeout=15) # Increased timeout slightly
+        return max(float(resp.headers.get(name, default)), 0.0)
+    except ValueError: # e.g. an HTTP-date Retry-After
+        return default
+
+def _send(method, url, **kwargs):
+    """Send a request through SESSION, waiting out 429 responses per Retry-After."""
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        resp = SESSION.request(method, url, **kwargs)
+        if resp.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+            return resp
+        delay = _header_seconds(resp, 'Retry-After', 1.0)
+        if delay > MAX_RETRY_AFTER:
+            return resp
+        # Don't log the URL: the Discord webhook URL embeds its token.
+        print(f"Rate limited; retrying in {delay:.1f}s ({attempt + 1}/{MAX_RATE_LIMIT_RETRIES})")
+        time.sleep(delay)
+
+def fetch_all_products(url, meta=None):
+    """Fetch a collection's products, revalidating against cached validators.
+
+    Returns (products, meta). products is a list of (handle, title, available)
+    tuples, None on failure, or UNCHANGED when the server reports the listing
+    hasn't changed since the cached response.
+    """
+    meta = meta or {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        resp = _send('GET', f"{url.rstrip('/')}/products.json?limit=250", headers=headers, timeout=15) # Increased timeout slightly
+        if resp.status_code == 304:
+            return UNCHANGED, meta
         resp.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        return resp.json().get('products', [])
-    except requests.exceptions.RequestException as e:
+        # Parse the raw bytes directly rather than decoding to str first.
+        raw_products = _json_loads(resp.content).get('products', [])
+        # Keep only the fields the diff needs so the full payload tree can be
+        # freed while the other collections are still being fetched.
+        products = [
+            (p['handle'], p['title'], any(map(_variant_available, p.get('variants') or ())))
+            for p in raw_products
+        ]
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
         print(f"Error fetching products from {url}: {e}")
-        return None # Return None to indicate failure
+        return None, None # Return None to indicate failure
+
+    new_meta = {}
+    if resp.headers.get('ETag'):
+        new_meta['etag'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified'):
+        new_meta['last_modified'] = resp.headers['Last-Modified']
+    return products, new_meta
+
+def _discord_len(text):
+    # Discord counts UTF-16 code units, so emoji outside the BMP count as two.
+    return len(text.encode('utf-16-le')) // 2
 
 def chunk_text_by_lines(text, limit=2000):
     lines = text.splitlines(keepends=True)
-    chunks, cur = [], ""
+    chunks, cur, cur_len = [], [], 0
     for line in lines:
-        if len(cur) + len(line) > limit:
-            chunks.append(cur.strip()); cur = "" # Use strip to remove trailing newline if it caused chunking
-        cur += line
-    if cur: chunks.append(cur.strip())
+        line_len = _discord_len(line)
+        if cur and cur_len + line_len > limit:
+            chunks.append("".join(cur).strip()); cur, cur_len = [], 0 # Use strip to remove trailing newline if it caused chunking
+        cur.append(line)
+        cur_len += line_len
+    if cur: chunks.append("".join(cur).strip())
     return chunks
 
+def build_embed_payloads(message):
+    """Pack the message into as few webhook payloads of embeds as Discord allows."""
+    payloads, embeds, total = [], [], 0
+    for description in chunk_text_by_lines(message, limit=EMBED_DESCRIPTION_LIMIT):
+        description_len = _discord_len(description)
+        if embeds and (len(embeds) == MAX_EMBEDS_PER_MESSAGE or total + description_len > EMBED_TOTAL_LIMIT):
+            payloads.append({'embeds': embeds})
+            embeds, total = [], 0
+        embeds.append({'description': description})
+        total += description_len
+    if embeds: payloads.append({'embeds': embeds})
+    return payloads
+
 def notify_discord(message):
     if not DISCORD_WEBHOOK:
         print("Discord webhook not configured.")
         return
 
-    chunks = chunk_text_by_lines(message)
-    for idx, chunk in enumerate(chunks, start=1):
-        print(f"Sending chunk {idx}/{len(chunks)}...")
+    # Embeds fit roughly twice as much text per POST as plain 2000-char content,
+    # so a typical alert goes out in a single request.
+    payloads = build_embed_payloads(message)
+    total = len(payloads)
+    for idx, payload in enumerate(payloads, start=1):
+        print(f"Sending message {idx}/{total}...")
         try:
-            resp = requests.post(DISCORD_WEBHOOK, json={'content': chunk}, timeout=10) # Added timeout
+            resp = _send('POST', DISCORD_WEBHOOK, json=payload, timeout=10) # Added timeout
             resp.raise_for_status()
-            print(f"→ Sent chunk {idx}/{len(chunks)}")
+            print(f"→ Sent message {idx}/{total}")
+            # Pace the remaining messages when the webhook's bucket is exhausted.
+            if idx < total and resp.headers.get('X-RateLimit-Remaining') == '0':
+                time.sleep(_header_seconds(resp, 'X-RateLimit-Reset-After', 1.0))
         except requests.exceptions.RequestException as e:
-            print(f"Error sending Discord webhook message chunk {idx}/{len(chunks)}: {e}")
+            print(f"Error sending Discord webhook message {idx}/{total}: {e}")
             break
 
-
 def main():
     global DISCORD_WEBHOOK
     load_dotenv()
@@ -80,81 +247,77 @@ def main():
     state = load_state()
     # Use .get with a default empty dict for safety if state file is corrupted initially
     old_products_state = state.get('products', {})
-    new_state = {'products': {}}
+    old_meta = state.get('meta', {})
+    new_state = {'schema': STATE_SCHEMA, 'products': {}, 'meta': {}}
     new_items_to_notify, restocked_to_notify = [], []
 
     # Keep track of handles processed in this run to identify removed items if needed later
     processed_handles = set()
 
+    # Fetches are I/O-bound, so issue them concurrently and diff sequentially.
     for url in urls:
         print(f"Checking {url}…")
-        products = fetch_all_products(url)
+    with ThreadPoolExecutor(max_workers=min(32, len(urls))) as executor:
+        results = list(executor.map(fetch_all_products, urls, [old_meta.get(url) for url in urls]))
 
+    for url, (products, url_meta) in zip(urls, results):
         if products is None: # Skip this URL if fetching failed
              continue
 
-
-        for p in products:
-            handle = p['handle']
-            title  = p['title']
-            current_avail  = any(v.get('available') for v in p.get('variants', []))
-
-            # Add handle to processed set
-            processed_handles.add(handle)
-
-            # Get the previous state for this product
+        if products is UNCHANGED:
+            # Nothing changed upstream, so carry this collection's products over as-is.
+            print(f"{url} not modified since last check.")
+            for handle in url_meta.get('handles', []):
+                if handle in old_products_state:
+                    new_state['products'][handle] = old_products_state[handle]
+                    processed_handles.add(handle)
+            new_state['meta'][url] = url_meta
+            continue
+
+        if url_meta:
+            # Remember which products came from this URL so a 304 can reuse them.
+            url_meta['handles'] = [handle for handle, _, _ in products]
+            new_state['meta'][url] = url_meta
+
+        current = {handle: (title, avail) for handle, title, avail in products}
+        processed_handles.update(current)
+
+        # Classify with set algebra on the handle sets, then walk `current` so
+        # alerts keep the collection's order.
+        new_handles = {h for h in current.keys() - old_products_state.keys() if current[h][1]}
+        restocked_handles = {
+            h for h in current.keys() & old_products_state.keys()
+            # Was unavailable and not yet notified, now available
+            if current[h][1] and not old_products_state[h].available and not old_products_state[h].notified
+        }
+        # Links are only built for products that are actually being announced.
+        base = url + '/products/'
+        new_items_to_notify += [(t, base + h) for h, (t, _) in current.items() if h in new_handles]
+        restocked_to_notify += [(t, base + h) for h, (t, _) in current.items() if h in restocked_handles]
+        notified_handles = new_handles | restocked_handles
+
+        for handle, (title, current_avail) in current.items():
             old_p_state = old_products_state.get(handle)
-
-            # Determine previous availability and notification status, defaulting to False
-            old_avail = old_p_state.get('available', False) if old_p_state else False
-            old_notified_for_available = old_p_state.get('notified_for_available', False) if old_p_state else False
-
-            # Initialize the new state for this product, inheriting old notification status
-            new_p_state = {
-                'title': title,
-                'available': current_avail,
-                'notified_for_available': old_notified_for_available # Start with the old notification status
-            }
-
-            is_new_item = handle not in old_products_state
-            is_restock_transition = not old_avail and current_avail # Was unavailable, now available
-
-            should_notify_this_product = False
-
-            if is_new_item and current_avail:
-
-                 if not new_p_state['notified_for_available']:
-                    new_items_to_notify.append((title, f"{url}/products/{handle}"))
-                    should_notify_this_product = True
-
-            elif is_restock_transition:
-    
-                if not new_p_state['notified_for_available']:
-                    restocked_to_notify.append((title, f"{url}/products/{handle}"))
-                    should_notify_this_product = True
-
-            if current_avail and should_notify_this_product:
-
-                 new_p_state['notified_for_available'] = True
-            elif not current_avail:
-
-                new_p_state['notified_for_available'] = False
-
-            new_state['products'][handle] = new_p_state
-
-    for handle, old_p_state in old_products_state.items():
-        if handle not in processed_handles:
-            print(f"Product '{old_p_state.get('title', handle)}' ({handle}) not found in current fetch.")
-
-            carried_over_state = {
-                 'title': old_p_state.get('title', handle),
-                 'available': False, # Assume unavailable if not found
-                 'notified_for_available': False # Reset flag so a notification is sent if it reappears
-            }
-            new_state['products'][handle] = carried_over_state
-
-    save_state(new_state)
-    print("State saved.")
+            # Keep the notification flag while the product stays available and
+            # reset it once it goes out of stock.
+            notified = current_avail and (handle in notified_handles or (old_p_state is not None and old_p_state.notified))
+            new_state['products'][handle] = ProductState(title, current_avail, notified)
+
+    # Sorted so state.json is written in a stable order between runs.
+    for handle in sorted(old_products_state.keys() - processed_handles):
+        title = old_products_state[handle].title or handle
+        print(f"Product '{title}' ({handle}) not found in current fetch.")
+
+        # Assume unavailable if not found and reset the flag so a
+        # notification is sent if it reappears
+        new_state['products'][handle] = ProductState(title, False, False)
+
+    # Most polls change nothing; skip rewriting state.json in that case.
+    if new_state != state:
+        save_state(new_state)
+        print("State saved.")
+    else:
+        print("State unchanged; not saving.")
 
     if not new_items_to_notify and not restocked_to_notify:
         print("No new products or restocks to notify about.")